@@ -1,28 +1,129 @@
 import os
-from flask import Flask, request, abort, jsonify
+import time
+import click
+from flask import Flask, request, abort, jsonify, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+import math
 import random
 
-from models import setup_db, Question, Category
+from models import setup_db, init_db, warmup_db, database_path, Question, Category, QuestionStats
+from .admission import setup_admission
+from .snapshots import setup_snapshots, HOMEPAGE_KEY, category_key
+from .telemetry import setup_telemetry
+from .partitions import setup_partitions, partition_questions, all_questions, category_questions
+from .buckets import setup_buckets, draw_adaptive_question
 
 QUESTIONS_PER_PAGE = 10
 
 def paginate_questions(request, selection):
   page = request.args.get('page', 1, type=int)
+  questions = [question.format() for question in selection]
+  return questions_for_page(questions, page)
+
+
+def questions_for_page(questions, page):
   start = (page - 1) * QUESTIONS_PER_PAGE
   end = start + QUESTIONS_PER_PAGE
 
-  questions = [question.format() for question in selection]
   current_questions = questions[start:end]
 
   return current_questions
 
 
+def questions_page_data(page):
+  # Get full list of categories and format appropriately for jsonify
+  categories = Category.query.all()
+  formatted_categories = [category.format() for category in categories]
+
+  # Get all (formatted) questions and then pass to questions_for_page() to set up pagination
+  questions = all_questions()
+  current_questions = questions_for_page(questions, page)
+
+  # Define arrays for category data
+  category_ids = []
+  category_types = []
+
+  # Populate arrays with actual values
+  for cat in formatted_categories:
+    category_ids.append(cat['id'])
+    category_types.append(cat['type'])
+
+  # Combine arrays to create dictionary with the required data and format
+  categories_dict = dict(zip(category_ids, category_types))
+
+  return {
+    'categories': categories_dict,
+    'questions': current_questions,
+    'total_questions': len(questions)
+  }
+
+
+def category_questions_data(category_id):
+  # Get category data based on ID
+  category_data = Category.query.filter(Category.id == category_id).all()
+  category_list = [category.format() for category in category_data]
+
+  if len(category_list) == 0:
+    return None
+
+  # Get question data based on selected category
+  question_list = category_questions(category_id)
+
+  return {
+    'questions': question_list,
+    'categories': category_list,
+    'total_questions': len(question_list),
+    'current_category': category_list[0]['type']
+  }
+
+
 def create_app(test_config=None):
   # create and configure the app
+  started = time.perf_counter()
   app = Flask(__name__)
-  setup_db(app)
+  if test_config is not None:
+    app.config.from_mapping(test_config)
+
+  # No database I/O here: tables are created with `flask init-db` and
+  # connections are opened lazily on the first request
+  setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI', database_path))
+
+  # Optional preload warmup (e.g. gunicorn --preload); leaves the pool empty before workers fork
+  if app.config.get('DB_WARMUP'):
+    warmup_db(app)
+
+  @app.cli.command('init-db')
+  def init_db_command():
+    """Create the database tables."""
+    init_db(app)
+    click.echo('Initialized the database.')
+
+  @app.cli.command('partition-questions')
+  def partition_questions_command():
+    """Partition the questions table by category (PostgreSQL)."""
+    try:
+      if partition_questions(app):
+        click.echo('Partitioned the questions table. Set QUESTION_PARTITIONING to route reads to partitions.')
+      else:
+        click.echo('The questions table is already partitioned.')
+    except RuntimeError as error:
+      raise click.ClickException(str(error))
+
+  # Per-route concurrency and rate limits; overload is shed before the view runs
+  limiters = setup_admission(app, app.config.get('ADMISSION_LIMITS'))
+
+  # Precomputed payloads for the landing page and category listings, refreshed after writes
+  snapshots = setup_snapshots(app, questions_page_data, category_questions_data)
+
+  # Quiz answer events are queued in-process and written in batches
+  telemetry = setup_telemetry(app)
+
+  # Category reads go to a single partition, "ALL" reads fan out across partitions
+  setup_partitions(app)
+
+  # In-memory (category, difficulty) buckets for the adaptive quiz mode
+  setup_buckets(app)
 
 
   '''
@@ -77,37 +178,22 @@ def create_app(test_config=None):
   @app.route('/questions')
   def get_paginated_questions():
 
-    # Get full list of categories and format appropriately for jsonify
-    categories = Category.query.all()
-    formatted_categories = [category.format() for category in categories]
-
-    # Get all questions and then pass to paginate_questions() to format for jsonify
-    # and set up pagination
-    selection = Question.query.order_by(Question.id).all()
-    current_questions = paginate_questions(request, selection)
-
-    # Define arrays for category data
-    category_ids = []
-    category_types = []
-
-    # Populate arrays with actual values
-    for cat in formatted_categories:
-      category_ids.append(cat['id'])
-      category_types.append(cat['type'])
-
-    # Combine arrays to create dictionary with the required data and format
-    categories_dict = dict(zip(category_ids, category_types))
-
+    # The landing page is served from its snapshot; other pages are computed
+    page = request.args.get('page', 1, type=int)
+    if page == 1:
+      data = snapshots.get(HOMEPAGE_KEY)
+    else:
+      data = questions_page_data(page)
 
-    if len(current_questions) == 0:
+    if len(data['questions']) == 0:
       abort(404)
 
     return jsonify({
       'success': True,
-      'categories': categories_dict,
+      'categories': data['categories'],
       'current_category': None,
-      'questions': current_questions,
-      'total_questions': len(Question.query.all())
+      'questions': data['questions'],
+      'total_questions': data['total_questions']
     })
 
   '''
@@ -129,16 +215,16 @@ def create_app(test_config=None):
 
       # Execute delete transaction
       question.delete()
-      selection = Question.query.order_by(Question.id).all()
+      questions = all_questions()
 
       # Ensure questions are displayed with pagination
-      current_questions = paginate_questions(request, selection)
+      current_questions = questions_for_page(questions, request.args.get('page', 1, type=int))
 
       return jsonify({
         'success': True,
         'deleted': question.id,
         'questions': current_questions,
-        'total_questions': len(Question.query.all())
+        'total_questions': len(questions)
       })
 
     except:
@@ -205,14 +291,14 @@ def create_app(test_config=None):
         question.insert()
 
         # Display latest data with pagination
-        selection = Question.query.order_by(Question.id).all()
-        current_questions = paginate_questions(request, selection)
+        questions = all_questions()
+        current_questions = questions_for_page(questions, request.args.get('page', 1, type=int))
 
         return jsonify({
           'success': True,
           'created': question.id,
           'questions': current_questions,
-          'total_questions': len(Question.query.all())
+          'total_questions': len(questions)
         })
 
     except:
@@ -230,36 +316,18 @@ def create_app(test_config=None):
 
   @app.route('/categories/<int:id>/questions')
   def get_categories_questions(id):
-    # Get category data based on ID
-    category_id = id
-    category_data = Category.query.filter(Category.id == category_id).all()
-    category_list = [category.format() for category in category_data]
+    # Served from the category's snapshot; None means the category does not exist
+    data = snapshots.get(category_key(id))
 
-    # Get question data based on selected category
-    question_data = Question.query.filter(Question.category == category_id).all()
-    question_list = [question.format() for question in question_data]
-
-    if len(question_list) == 0 or (category_list) == 0:
+    if data is None or len(data['questions']) == 0:
       abort(404)
 
-    # Define arrays for category data
-    category_ids = []
-    category_types = []
-
-    # Populate arrays with actual values
-    for cat in category_list:
-      category_ids.append(cat['id'])
-      category_types.append(cat['type'])
-
-    # Combine arrays to create dictionary with the required data and format
-    categories_dict = dict(zip(category_ids, category_types))
-
     return jsonify({
       'success': True,
-      'questions': question_list,
-      'categories': category_list,
-      'total_questions': len(question_list),
-      'current_category': categories_dict[category_id]
+      'questions': data['questions'],
+      'categories': data['categories'],
+      'total_questions': data['total_questions'],
+      'current_category': data['current_category']
     })
 
 
@@ -290,12 +358,21 @@ def create_app(test_config=None):
     quiz_category_id = quiz_category.get('id')
     quiz_category_id = int(quiz_category_id)
     previous_questions = body.get('previous_questions', None)
+    mode = body.get('mode', None)
 
     # Get questions
-    if quiz_category_type == 'click':
+    if mode == 'adaptive':
+      # Harder questions after correct answers, easier after misses
+      streak = body.get('streak', 0)
+      if not isinstance(streak, int) or isinstance(streak, bool):
+        abort(400)
+
+      cat_id = None if quiz_category_type == 'click' else quiz_category_id + 1
+      random_q = draw_adaptive_question(cat_id, streak, set(previous_questions or [])) or {}
+
+    elif quiz_category_type == 'click':
       cat_id = 0
-      questions_list = Question.query.order_by(Question.id).all()
-      formatted_questions_list = [question.format() for question in questions_list]
+      formatted_questions_list = all_questions()
       random_q = random.choice(formatted_questions_list)
 
       # Loop to check for previous questions
@@ -316,8 +393,7 @@ def create_app(test_config=None):
 
     else:
       cat_id = quiz_category_id + 1
-      questions_list = Question.query.filter(Question.category == cat_id).all()
-      formatted_questions_list = [question.format() for question in questions_list]
+      formatted_questions_list = category_questions(cat_id)
 
       # Loop to check for previous questions
       counter = 1
@@ -335,6 +411,10 @@ def create_app(test_config=None):
       else:
         random_q = random.choice(formatted_questions_list)
 
+    # Record which question was served
+    if random_q:
+      telemetry.record('served', random_q['id'])
+
     return jsonify({
       'success': True,
       'quizCategory': 'ALL' if quiz_category_type == 'click' else quiz_category_type,
@@ -342,6 +422,90 @@ def create_app(test_config=None):
       'question': random_q
     })
 
+  '''
+  POST endpoint to record whether a quiz question was answered correctly.
+  The event is queued and written in the background; recorded is False
+  if it had to be dropped because the queue was full.
+  '''
+  @app.route('/quizzes/answers', methods=['POST'])
+  def record_quiz_answer():
+
+    body = request.get_json()
+
+    if not body:
+      abort(400)
+
+    question_id = body.get('question_id', None)
+    correct = body.get('correct', None)
+
+    if not isinstance(question_id, int) or isinstance(question_id, bool) or not isinstance(correct, bool):
+      abort(400)
+
+    return jsonify({
+      'success': True,
+      'recorded': telemetry.record('answered', question_id, correct)
+    })
+
+  '''
+  GET endpoints for quiz statistics. Both read only the rolled up
+  question_stats aggregates, never the raw answer events.
+  '''
+  @app.route('/questions/<int:id>/stats')
+  def get_question_stats(id):
+    stats = QuestionStats.query.get(id)
+
+    if stats is None:
+      abort(404)
+
+    return jsonify({
+      'success': True,
+      'stats': stats.format()
+    })
+
+  @app.route('/categories/<int:id>/stats')
+  def get_category_stats(id):
+    question_stats = QuestionStats.query.filter(QuestionStats.category == id).order_by(QuestionStats.question_id).all()
+
+    if len(question_stats) == 0:
+      abort(404)
+
+    served = sum(stats.served for stats in question_stats)
+    answered = sum(stats.answered for stats in question_stats)
+    correct = sum(stats.correct for stats in question_stats)
+
+    return jsonify({
+      'success': True,
+      'category': id,
+      'served': served,
+      'answered': answered,
+      'correct': correct,
+      'correct_rate': correct / answered if answered else None,
+      'questions': [stats.format() for stats in question_stats]
+    })
+
+  '''
+  GET endpoint reporting how long create_app() took, so worker cold starts can be tracked,
+  and the telemetry queue counters (dropped events mean TELEMETRY_QUEUE_SIZE is too small).
+  '''
+  @app.route('/status')
+  def get_status():
+    return jsonify({
+      'success': True,
+      'startup_seconds': app.config['STARTUP_SECONDS'],
+      'telemetry': telemetry.stats()
+    })
+
+  '''
+  GET endpoint exposing admission counters (queue waits and shed requests)
+  so the per-route limits can be tuned.
+  '''
+  @app.route('/admission')
+  def get_admission_stats():
+    return jsonify({
+      'success': True,
+      'routes': {endpoint: limiter.stats() for endpoint, limiter in limiters.items()}
+    })
+
   '''
   @TODO: 
   Create error handlers for all expected errors 
@@ -387,4 +551,27 @@ def create_app(test_config=None):
       "message": "Method Not Allowed"
     }), 405
 
+  @app.errorhandler(429)
+  def too_many_requests(error):
+    response = jsonify({
+      "success": False,
+      "error": 429,
+      "message": "Too Many Requests"
+    })
+    response.headers['Retry-After'] = str(math.ceil(g.get('retry_after', 1)))
+    return response, 429
+
+  @app.errorhandler(503)
+  def service_unavailable(error):
+    response = jsonify({
+      "success": False,
+      "error": 503,
+      "message": "Service Unavailable"
+    })
+    response.headers['Retry-After'] = str(math.ceil(g.get('retry_after', 1)))
+    return response, 503
+
+  # Record cold-start time so worker boot can be tracked (reported by GET '/status')
+  app.config['STARTUP_SECONDS'] = time.perf_counter() - started
+
   return app
\ No newline at end of file
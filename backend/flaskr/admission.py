@@ -0,0 +1,158 @@
+import threading
+import time
+
+from flask import request, abort, g
+
+'''
+Default admission limits, keyed by endpoint name.
+  - concurrency: requests allowed to run at the same time
+  - queue_timeout: seconds a request may wait for a free slot before it is shed with a 503
+  - rate / burst: token bucket refill rate (requests per second) and capacity, shed with a 429
+Any key can be left out (or set to None) to disable that limit.
+Override per app with create_app({'ADMISSION_LIMITS': {...}}).
+'''
+DEFAULT_LIMITS = {
+  'create_question': {'concurrency': 4, 'queue_timeout': 0.5, 'rate': 20, 'burst': 40},
+  'get_questions_to_play': {'concurrency': 4, 'queue_timeout': 0.5, 'rate': 20, 'burst': 40},
+}
+
+
+'''
+TokenBucket
+    refills at `rate` tokens per second up to `burst` tokens
+'''
+class TokenBucket:
+
+  def __init__(self, rate, burst):
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self.tokens = float(burst)
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def take(self):
+    # Returns 0 if a token was taken, otherwise the seconds until one is available
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+
+      if self.tokens >= 1:
+        self.tokens -= 1
+        return 0
+
+      return (1 - self.tokens) / self.rate
+
+
+'''
+RouteLimiter
+    concurrency slots, token bucket and counters for a single endpoint
+'''
+class RouteLimiter:
+
+  def __init__(self, concurrency=None, queue_timeout=0, rate=None, burst=None):
+    self.concurrency = concurrency
+    self.queue_timeout = queue_timeout or 0
+    self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+    self.bucket = TokenBucket(rate, burst or rate) if rate else None
+
+    self.lock = threading.Lock()
+    self.admitted = 0
+    self.in_flight = 0
+    self.queued = 0
+    self.queue_wait_total = 0.0
+    self.queue_wait_max = 0.0
+    self.shed_rate_limited = 0
+    self.shed_overloaded = 0
+
+  def acquire(self):
+    # Returns (status, retry_after); status is None when the request is admitted
+    if self.bucket is not None:
+      wait = self.bucket.take()
+      if wait:
+        with self.lock:
+          self.shed_rate_limited += 1
+        return 429, wait
+
+    if self.slots is not None:
+      started = time.monotonic()
+      acquired = self.slots.acquire(blocking=False)
+
+      if not acquired:
+        with self.lock:
+          self.queued += 1
+        acquired = self.slots.acquire(timeout=self.queue_timeout) if self.queue_timeout > 0 else False
+        waited = time.monotonic() - started
+
+        with self.lock:
+          self.queued -= 1
+          self.queue_wait_total += waited
+          self.queue_wait_max = max(self.queue_wait_max, waited)
+          if not acquired:
+            self.shed_overloaded += 1
+
+        if not acquired:
+          return 503, max(self.queue_timeout, 1)
+
+    with self.lock:
+      self.admitted += 1
+      self.in_flight += 1
+
+    return None, 0
+
+  def release(self):
+    with self.lock:
+      self.in_flight -= 1
+
+    if self.slots is not None:
+      self.slots.release()
+
+  def stats(self):
+    with self.lock:
+      return {
+        'concurrency': self.concurrency,
+        'admitted': self.admitted,
+        'in_flight': self.in_flight,
+        'queued': self.queued,
+        'queue_wait_total': round(self.queue_wait_total, 6),
+        'queue_wait_max': round(self.queue_wait_max, 6),
+        'shed_rate_limited': self.shed_rate_limited,
+        'shed_overloaded': self.shed_overloaded,
+      }
+
+
+'''
+setup_admission(app, limits)
+    registers a limiter per configured endpoint and rejects overload before the view runs
+'''
+def setup_admission(app, limits=None):
+  if limits is None:
+    limits = DEFAULT_LIMITS
+
+  limiters = {endpoint: RouteLimiter(**options) for endpoint, options in limits.items()}
+  app.extensions['admission'] = limiters
+
+  @app.before_request
+  def admit_request():
+    # CORS preflights are cheap and must not be shed (browsers report that as a CORS failure)
+    if request.method == 'OPTIONS':
+      return None
+
+    limiter = limiters.get(request.endpoint)
+    if limiter is None:
+      return None
+
+    status, retry_after = limiter.acquire()
+    if status is not None:
+      g.retry_after = retry_after
+      abort(status)
+
+    g.admission_limiter = limiter
+
+  @app.teardown_request
+  def release_request(exception=None):
+    limiter = g.pop('admission_limiter', None)
+    if limiter is not None:
+      limiter.release()
+
+  return limiters
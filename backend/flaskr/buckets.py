@@ -0,0 +1,197 @@
+import random
+import threading
+import time
+
+from flask import current_app
+
+from models import db, on_questions_changed
+from .partitions import all_questions
+
+DIFFICULTIES = (1, 2, 3, 4, 5)
+# Difficulty served to a player with no streak
+START_DIFFICULTY = 3
+# Seconds before the buckets are rebuilt to pick up writes made by other worker processes
+DEFAULT_TTL = 60
+
+
+'''
+DifficultyBuckets
+    questions held in memory by (category, difficulty); category None holds every category
+    each bucket is a list plus an id -> index map so inserts, deletes and random draws are O(1);
+    a draw that hits already played questions costs O(1) per hit, never a scan of the bucket
+    rebuilds are made off to the side and swapped in, so draws never wait on a full reload
+'''
+class DifficultyBuckets:
+
+  def __init__(self, ttl=DEFAULT_TTL):
+    self.ttl = ttl
+    self.lock = threading.RLock()
+    self.load_lock = threading.Lock()
+    self.buckets = {}
+    self.positions = {}
+    self.questions = {}
+    self.loaded_at = None
+    self.rebuilding = False
+    # Changes committed while a rebuild is running, replayed onto the rebuilt buckets
+    self.replay = None
+
+  def keys(self, question):
+    category = int(question['category']) if question['category'] is not None else None
+    difficulty = int(question['difficulty']) if question['difficulty'] is not None else None
+    return [(category, difficulty), (None, difficulty)] if category is not None else [(None, difficulty)]
+
+  def load(self, questions):
+    fresh = DifficultyBuckets(self.ttl)
+    for question in questions:
+      fresh.add(question)
+
+    with self.lock:
+      self.buckets = fresh.buckets
+      self.positions = fresh.positions
+      self.questions = fresh.questions
+      replay, self.replay = self.replay, None
+      self.apply(replay or [])
+      self.loaded_at = time.monotonic()
+      self.rebuilding = False
+
+  def loaded(self):
+    return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+
+  def claim_rebuild(self):
+    # Only one caller rebuilds at a time; changes from then on are kept for replay
+    with self.lock:
+      if self.rebuilding:
+        return False
+      self.rebuilding = True
+      self.replay = []
+      return True
+
+  def abandon_rebuild(self):
+    with self.lock:
+      self.rebuilding = False
+      self.replay = None
+
+  def apply(self, changes):
+    with self.lock:
+      if self.loaded_at is None and self.replay is None:
+        return
+      if self.replay is not None:
+        self.replay.extend(changes)
+
+      for action, question in changes:
+        if action == 'insert':
+          self.add(question)
+        else:
+          self.remove(question['id'])
+
+  def add(self, question):
+    with self.lock:
+      self.remove(question['id'])
+      self.questions[question['id']] = question
+      for key in self.keys(question):
+        bucket = self.buckets.setdefault(key, [])
+        self.positions.setdefault(key, {})[question['id']] = len(bucket)
+        bucket.append(question)
+
+  def remove(self, question_id):
+    with self.lock:
+      question = self.questions.pop(question_id, None)
+      if question is None:
+        return
+
+      for key in self.keys(question):
+        bucket = self.buckets[key]
+        positions = self.positions[key]
+
+        # Swap with the last question so the removal is O(1)
+        index = positions.pop(question_id)
+        last = bucket.pop()
+        if index < len(bucket):
+          bucket[index] = last
+          positions[last['id']] = index
+
+  def draw(self, category, difficulty, exclude=()):
+    with self.lock:
+      bucket = self.buckets.get((category, difficulty))
+      if not bucket:
+        return None
+      positions = self.positions[(category, difficulty)]
+
+      # Partial Fisher-Yates: a played question is swapped behind the range still being drawn from
+      remaining = len(bucket)
+      while remaining:
+        index = random.randrange(remaining)
+        question = bucket[index]
+        if question['id'] not in exclude:
+          return question
+
+        remaining -= 1
+        last = bucket[remaining]
+        bucket[index], bucket[remaining] = last, question
+        positions[last['id']] = index
+        positions[question['id']] = remaining
+
+      return None
+
+  def draw_adaptive(self, category, streak, exclude=()):
+    # A winning streak raises the target difficulty, a losing streak lowers it;
+    # if that bucket is used up, the nearest difficulty in the streak's direction is tried first
+    target = min(max(START_DIFFICULTY + streak, DIFFICULTIES[0]), DIFFICULTIES[-1])
+    direction = 1 if streak >= 0 else -1
+    order = sorted(DIFFICULTIES, key=lambda difficulty: (abs(difficulty - target), (target - difficulty) * direction))
+
+    for difficulty in order:
+      question = self.draw(category, difficulty, exclude)
+      if question is not None:
+        return question
+
+    return None
+
+
+'''
+setup_buckets(app)
+    registers the difficulty buckets; they are built on first use and kept up to date on writes
+'''
+def setup_buckets(app):
+  buckets = DifficultyBuckets(app.config.get('QUIZ_BUCKETS_TTL', DEFAULT_TTL))
+  app.extensions['buckets'] = buckets
+  return buckets
+
+
+def rebuild_buckets(app, buckets):
+  with app.app_context():
+    try:
+      buckets.load(all_questions())
+    except Exception:
+      buckets.abandon_rebuild()
+      app.logger.exception('Failed to rebuild quiz difficulty buckets')
+    finally:
+      db.session.remove()
+
+
+def draw_adaptive_question(category, streak, exclude=()):
+  buckets = current_app.extensions['buckets']
+
+  if buckets.loaded_at is None:
+    # Nothing to draw from yet: the first caller loads, the others wait for it
+    with buckets.load_lock:
+      if buckets.loaded_at is None and buckets.claim_rebuild():
+        try:
+          buckets.load(all_questions())
+        except Exception:
+          buckets.abandon_rebuild()
+          raise
+
+  elif not buckets.loaded() and buckets.claim_rebuild():
+    # Expired: keep drawing from the current buckets while one thread reloads them
+    app = current_app._get_current_object()
+    threading.Thread(target=rebuild_buckets, args=(app, buckets), name='quiz-buckets', daemon=True).start()
+
+  return buckets.draw_adaptive(category, streak, exclude)
+
+
+@on_questions_changed
+def update_buckets(changes):
+  buckets = current_app.extensions.get('buckets')
+  if buckets is not None:
+    buckets.apply(changes)
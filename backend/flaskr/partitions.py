@@ -0,0 +1,198 @@
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import column, select, table, text
+
+from models import db, Question, Category
+
+PARTITION_PREFIX = 'questions_c'
+DEFAULT_PARTITION = 'questions_default'
+DEFAULT_WORKERS = 4
+
+QUESTION_COLUMNS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+
+def partition_table(name):
+  return table(name, *[column(column_name) for column_name in QUESTION_COLUMNS])
+
+
+'''
+partition_questions(app)
+    converts the questions table (as found on the search_path) into a PostgreSQL list-partitioned
+    table with one partition per category (questions_c<id>) plus questions_default, which also
+    holds questions without a category; ids, the id sequence and foreign keys are kept
+    category stays nullable, so (id, category) is a unique key rather than a primary key
+'''
+def partition_questions(app):
+  with app.app_context():
+    engine = db.engine
+    if engine.dialect.name != 'postgresql':
+      raise RuntimeError('Question partitioning requires PostgreSQL')
+
+    with engine.begin() as connection:
+      partitioned = connection.execute(text(
+        "SELECT count(*) FROM pg_partitioned_table WHERE partrelid = to_regclass('questions')"
+      )).scalar()
+      if partitioned:
+        return False
+
+      category_ids = [category_id for category_id, in connection.execute(select([Category.__table__.c.id]))]
+      sequence = connection.execute(text("SELECT pg_get_serial_sequence('questions', 'id')")).scalar()
+      owner = connection.execute(text("SELECT pg_get_userbyid(relowner) FROM pg_class WHERE oid = 'questions'::regclass")).scalar()
+      foreign_keys = connection.execute(text(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = 'questions'::regclass AND contype = 'f'"
+      )).fetchall()
+
+      connection.execute(text('ALTER TABLE questions RENAME TO questions_unpartitioned'))
+      connection.execute(text('CREATE TABLE questions (LIKE questions_unpartitioned INCLUDING DEFAULTS) PARTITION BY LIST (category)'))
+      connection.execute(text('ALTER TABLE questions ADD UNIQUE (id, category)'))
+      for category_id in category_ids:
+        connection.execute(text("CREATE TABLE {}{} PARTITION OF questions FOR VALUES IN ('{}')".format(PARTITION_PREFIX, int(category_id), int(category_id))))
+      connection.execute(text('CREATE TABLE {} PARTITION OF questions DEFAULT'.format(DEFAULT_PARTITION)))
+      connection.execute(text('INSERT INTO questions SELECT * FROM questions_unpartitioned'))
+
+      # e.g. category -> categories(id) ON UPDATE CASCADE ON DELETE SET NULL from trivia.psql
+      quote = engine.dialect.identifier_preparer.quote
+      for name, definition in foreign_keys:
+        connection.execute(text('ALTER TABLE questions ADD CONSTRAINT {} {}'.format(quote(name), definition)))
+
+      # The id sequence can only be linked to a table with the same owner
+      connection.execute(text('ALTER TABLE questions OWNER TO {}'.format(quote(owner))))
+      if sequence is not None:
+        connection.execute(text('ALTER SEQUENCE {} OWNED BY questions.id'.format(sequence)))
+      connection.execute(text('DROP TABLE questions_unpartitioned'))
+
+    return True
+
+
+'''
+QuestionRouter
+    sends category reads to that category's partition and fans "ALL" reads out
+    across every partition in parallel, merging the results by id
+    each parallel read holds its own pooled connection; fan-outs share a budget of
+    max_connections (default: the engine's pool_size) and a read that cannot get its
+    connections right away uses a single query on the questions table instead
+    with partitioning disabled every read goes through the questions table
+'''
+class QuestionRouter:
+
+  def __init__(self, enabled, max_workers, max_connections=None):
+    self.enabled = enabled
+    self.max_workers = max_workers
+    self.max_connections = max_connections
+    self.tables = None
+    self.executor = None
+    self.connections = None
+    self.lock = threading.Lock()
+
+  def partitions(self):
+    # Discovered once; restart after running `flask partition-questions`
+    if self.tables is None:
+      with self.lock:
+        if self.tables is None:
+          names = db.session.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass('questions')"
+          )).fetchall()
+          tables = {}
+          for name, in names:
+            if name.startswith(PARTITION_PREFIX):
+              tables[int(name[len(PARTITION_PREFIX):])] = partition_table(name)
+            elif name == DEFAULT_PARTITION:
+              tables[None] = partition_table(name)
+
+          if not tables:
+            # Serving empty results would 404 every listing; read the plain table instead
+            current_app.logger.warning('QUESTION_PARTITIONING is enabled but questions has no partitions; '
+                                       'run `flask partition-questions`. Reading the unpartitioned table.')
+            self.enabled = False
+          else:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='question-partitions')
+            # Leaves max_overflow for the request threads' own sessions
+            pool_size = db.engine.pool.size() if hasattr(db.engine.pool, 'size') else self.max_workers
+            self.connections = threading.BoundedSemaphore(self.max_connections or pool_size)
+          self.tables = tables
+
+    return self.tables
+
+  def active(self):
+    # Partition discovery turns routing off when the table turns out not to be partitioned
+    if self.enabled:
+      self.partitions()
+    return self.enabled
+
+  def category_questions(self, category_id):
+    if not self.active():
+      selection = Question.query.filter(Question.category == category_id).order_by(Question.id).all()
+      return [question.format() for question in selection]
+
+    tables = self.partitions()
+    partition = tables.get(category_id, tables.get(None))
+    if partition is None:
+      return []
+
+    rows = db.session.execute(select([partition]).where(partition.c.category == category_id).order_by(partition.c.id))
+    return [dict(row) for row in rows]
+
+  def reserve(self, count):
+    # Takes count connection slots without waiting; all or nothing
+    taken = 0
+    while taken < count and self.connections.acquire(blocking=False):
+      taken += 1
+
+    if taken < count:
+      for _ in range(taken):
+        self.connections.release()
+      return False
+    return True
+
+  def all_questions(self):
+    if not self.active():
+      selection = Question.query.order_by(Question.id).all()
+      return [question.format() for question in selection]
+
+    engine = db.engine
+    partitions = list(self.partitions().values())
+    needed = min(len(partitions), self.max_workers)
+
+    if not self.reserve(needed):
+      # Connections are short: one query through the parent table on the request's own connection
+      selection = Question.query.order_by(Question.id).all()
+      return [question.format() for question in selection]
+
+    def fetch(partition):
+      with engine.connect() as connection:
+        rows = connection.execute(select([partition]).order_by(partition.c.id))
+        return [dict(row) for row in rows]
+
+    try:
+      results = list(self.executor.map(fetch, partitions))
+    finally:
+      for _ in range(needed):
+        self.connections.release()
+
+    return list(heapq.merge(*results, key=lambda question: question['id']))
+
+
+'''
+setup_partitions(app)
+    registers the question router; enable with QUESTION_PARTITIONING once the table is partitioned
+'''
+def setup_partitions(app):
+  router = QuestionRouter(app.config.get('QUESTION_PARTITIONING', False),
+                          app.config.get('QUESTION_PARTITION_WORKERS', DEFAULT_WORKERS),
+                          app.config.get('QUESTION_PARTITION_CONNECTIONS'))
+  app.extensions['partitions'] = router
+  return router
+
+
+def all_questions():
+  return current_app.extensions['partitions'].all_questions()
+
+
+def category_questions(category_id):
+  return current_app.extensions['partitions'].category_questions(category_id)
@@ -0,0 +1,145 @@
+import datetime
+import json
+import queue
+import threading
+
+from flask import current_app
+from sqlalchemy import case, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from models import db, PageSnapshot, on_questions_changed
+
+# Seconds a snapshot may keep serving after a write before reads rebuild it inline
+DEFAULT_MAX_STALENESS = 5
+
+HOMEPAGE_KEY = 'questions:1'
+
+def category_key(category_id):
+  return 'category:{}'.format(category_id)
+
+
+'''
+SnapshotStore
+    builds, stores and refreshes the precomputed payloads for one app
+    refreshes after writes run on a background thread unless max_staleness is 0,
+    in which case the next read rebuilds the snapshot inline
+'''
+class SnapshotStore:
+
+  def __init__(self, app, build_homepage, build_category, max_staleness):
+    self.app = app
+    self.builders = {'questions': build_homepage, 'category': build_category}
+    self.max_staleness = max_staleness
+    self.pending = set()
+    self.queue = queue.Queue()
+    self.lock = threading.Lock()
+    self.worker = None
+
+  def build(self, key):
+    kind, value = key.split(':')
+    return self.builders[kind](int(value))
+
+  def get(self, key):
+    try:
+      snapshot = PageSnapshot.query.get(key)
+      if snapshot is None or snapshot.payload is None or snapshot.is_stale(self.max_staleness):
+        return self.refresh(key, snapshot.version if snapshot is not None else 0)
+      return json.loads(snapshot.payload)
+    except SQLAlchemyError as error:
+      # e.g. page_snapshots not created yet (run `flask init-db`); serve the live result
+      db.session.rollback()
+      self.app.logger.warning('Snapshot %s unavailable: %s', key, error)
+      return self.build(key)
+
+  def refresh(self, key, version=None):
+    # version must be read before building: any later write bumps it and keeps the snapshot dirty
+    if version is None:
+      version = db.session.query(PageSnapshot.version).filter(PageSnapshot.key == key).scalar() or 0
+    started = datetime.datetime.utcnow()
+    payload = self.build(key)
+
+    # Nothing worth caching (e.g. unknown category)
+    if payload is None:
+      return None
+
+    table = PageSnapshot.__table__
+    updated = db.session.execute(table.update().where(table.c.key == key).values(
+      payload=json.dumps(payload),
+      refreshed_at=started,
+      # Keep the dirty mark if another write landed while this snapshot was being built
+      dirty_since=case([(table.c.version > version, table.c.dirty_since)], else_=None)
+    ))
+
+    try:
+      if updated.rowcount == 0:
+        db.session.add(PageSnapshot(key, json.dumps(payload)))
+      db.session.commit()
+    except IntegrityError:
+      # Another worker stored it first
+      db.session.rollback()
+
+    return payload
+
+  def invalidate(self, keys):
+    table = PageSnapshot.__table__
+    now = datetime.datetime.utcnow()
+
+    # Missing rows get an empty placeholder so a first build running right now still sees the write
+    statement = insert(table).values([{'key': key, 'dirty_since': now, 'version': 1} for key in sorted(keys)])
+    statement = statement.on_conflict_do_update(index_elements=[table.c.key], set_={
+      'version': table.c.version + 1,
+      'dirty_since': func.coalesce(table.c.dirty_since, now)
+    })
+
+    with db.engine.begin() as connection:
+      connection.execute(statement)
+
+    if self.max_staleness > 0:
+      self.schedule(keys)
+
+  def schedule(self, keys):
+    with self.lock:
+      for key in set(keys) - self.pending:
+        self.pending.add(key)
+        self.queue.put(key)
+
+      if self.worker is None or not self.worker.is_alive():
+        self.worker = threading.Thread(target=self.run, name='snapshot-refresher', daemon=True)
+        self.worker.start()
+
+  def run(self):
+    while True:
+      key = self.queue.get()
+      with self.lock:
+        self.pending.discard(key)
+
+      with self.app.app_context():
+        try:
+          self.refresh(key)
+        except Exception:
+          self.app.logger.exception('Failed to refresh snapshot %s', key)
+        finally:
+          db.session.remove()
+
+
+'''
+setup_snapshots(app, build_homepage, build_category)
+    registers the snapshot store; build_homepage(page) and build_category(id) return the payloads
+'''
+def setup_snapshots(app, build_homepage, build_category):
+  store = SnapshotStore(app, build_homepage, build_category,
+                        app.config.get('SNAPSHOT_MAX_STALENESS', DEFAULT_MAX_STALENESS))
+  app.extensions['snapshots'] = store
+  return store
+
+
+@on_questions_changed
+def invalidate_snapshots(changes):
+  store = current_app.extensions.get('snapshots')
+  if store is None:
+    return
+
+  keys = {HOMEPAGE_KEY}
+  keys.update(category_key(data['category']) for action, data in changes if data['category'] is not None)
+  store.invalidate(keys)
@@ -0,0 +1,237 @@
+import atexit
+import datetime
+import queue
+import threading
+import time
+import weakref
+
+from sqlalchemy import case, func
+
+from models import db, Question, AnswerEvent, QuestionStats, RollupWatermark
+
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 500
+# Seconds to wait for a batch to fill before writing what there is
+DEFAULT_FLUSH_INTERVAL = 1.0
+# Seconds between rollups of answer_events into question_stats
+DEFAULT_ROLLUP_INTERVAL = 30
+# Events younger than this are left for the next rollup so that batches
+# still being committed by other workers are not skipped
+DEFAULT_ROLLUP_SETTLE = 5
+
+WATERMARK_NAME = 'question_stats'
+
+# Writers still running, stopped by the single exit handler below
+writers = weakref.WeakSet()
+
+
+'''
+TelemetryWriter
+    bounded in-process queue of answer events drained by a background thread,
+    which inserts them in batches and periodically rolls them up into question_stats
+    events are dropped (and counted) when the queue is full
+'''
+class TelemetryWriter:
+
+  def __init__(self, app, queue_size, batch_size, flush_interval, rollup_interval, rollup_settle):
+    self.app = app
+    self.queue = queue.Queue(maxsize=queue_size)
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.rollup_interval = rollup_interval
+    self.rollup_settle = rollup_settle
+
+    self.lock = threading.Lock()
+    self.rollup_lock = threading.Lock()
+    self.worker = None
+    self.stopping = threading.Event()
+    self.last_rollup = time.monotonic()
+    self.dropped = 0
+    self.written = 0
+
+  def record(self, kind, question_id, correct=None):
+    # Never blocks the request; returns False if the event was dropped
+    try:
+      self.queue.put_nowait({'question_id': question_id, 'kind': kind, 'correct': correct})
+    except queue.Full:
+      with self.lock:
+        self.dropped += 1
+      return False
+
+    self.start()
+    return True
+
+  def start(self):
+    if self.worker is not None and self.worker.is_alive():
+      return
+
+    with self.lock:
+      if self.stopping.is_set():
+        return
+      if self.worker is None or not self.worker.is_alive():
+        self.worker = threading.Thread(target=self.run, name='telemetry-writer', daemon=True)
+        self.worker.start()
+
+  def run(self):
+    while not self.stopping.is_set():
+      batch = self.collect()
+
+      with self.app.app_context():
+        try:
+          self.write(batch)
+          if time.monotonic() - self.last_rollup >= self.rollup_interval:
+            self.rollup()
+        except Exception:
+          db.session.rollback()
+          self.app.logger.exception('Failed to write %d answer events', len(batch))
+        finally:
+          db.session.remove()
+
+  def collect(self):
+    batch = []
+    deadline = time.monotonic() + self.flush_interval
+
+    while len(batch) < self.batch_size:
+      timeout = deadline - time.monotonic()
+      if timeout <= 0:
+        break
+      try:
+        batch.append(self.queue.get(timeout=timeout))
+      except queue.Empty:
+        break
+
+    return batch
+
+  def write(self, batch):
+    if not batch:
+      return
+
+    now = datetime.datetime.utcnow()
+    for event in batch:
+      event['created_at'] = now
+
+    db.session.execute(AnswerEvent.__table__.insert(), batch)
+    db.session.commit()
+
+    with self.lock:
+      self.written += len(batch)
+
+  def rollup(self):
+    with self.rollup_lock:
+      self.last_rollup = time.monotonic()
+
+      # Row lock serializes rollups across worker processes
+      watermark = RollupWatermark.query.filter_by(name=WATERMARK_NAME).with_for_update().one_or_none()
+      if watermark is None:
+        watermark = RollupWatermark(WATERMARK_NAME)
+        db.session.add(watermark)
+        db.session.flush()
+
+      cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.rollup_settle)
+      upper = db.session.query(func.max(AnswerEvent.id)).filter(
+        AnswerEvent.id > watermark.last_event_id,
+        AnswerEvent.created_at <= cutoff
+      ).scalar()
+
+      if upper is None:
+        db.session.commit()
+        return 0
+
+      rows = db.session.query(
+        AnswerEvent.question_id,
+        func.sum(case([(AnswerEvent.kind == 'served', 1)], else_=0)),
+        func.sum(case([(AnswerEvent.kind == 'answered', 1)], else_=0)),
+        func.sum(case([(AnswerEvent.correct == True, 1)], else_=0))
+      ).filter(
+        AnswerEvent.id > watermark.last_event_id,
+        AnswerEvent.id <= upper
+      ).group_by(AnswerEvent.question_id).all()
+
+      question_ids = [row[0] for row in rows]
+      existing = {stats.question_id: stats for stats in QuestionStats.query.filter(QuestionStats.question_id.in_(question_ids))}
+      missing = [question_id for question_id in question_ids if question_id not in existing]
+      categories = dict(db.session.query(Question.id, Question.category).filter(Question.id.in_(missing)).all()) if missing else {}
+
+      for question_id, served, answered, correct in rows:
+        stats = existing.get(question_id)
+        if stats is None:
+          # Events for ids that are not (or no longer) questions are dropped
+          if question_id not in categories:
+            continue
+          category = categories.get(question_id)
+          stats = QuestionStats(question_id, int(category) if category is not None else None)
+          db.session.add(stats)
+
+        stats.served += served or 0
+        stats.answered += answered or 0
+        stats.correct += correct or 0
+
+      watermark.last_event_id = upper
+      db.session.commit()
+
+      return len(rows)
+
+  def stop(self):
+    # Stops the background thread, then writes whatever it left in the queue.
+    # Events recorded afterwards stay queued until drain() is called again.
+    with self.lock:
+      self.stopping.set()
+      worker = self.worker
+
+    if worker is not None:
+      worker.join()
+    self.drain()
+    writers.discard(self)
+
+  def drain(self):
+    # Synchronously write everything still queued.
+    # The next periodic rollup (in any worker) picks the events up.
+    batch = []
+    while True:
+      try:
+        batch.append(self.queue.get_nowait())
+      except queue.Empty:
+        break
+
+    if not batch:
+      return
+
+    with self.app.app_context():
+      try:
+        self.write(batch)
+      except Exception:
+        self.app.logger.exception('Failed to write %d answer events at shutdown', len(batch))
+      finally:
+        db.session.remove()
+
+  def stats(self):
+    with self.lock:
+      return {
+        'queued': self.queue.qsize(),
+        'dropped': self.dropped,
+        'written': self.written
+      }
+
+
+'''
+setup_telemetry(app)
+    registers the answer event writer for the app
+'''
+def setup_telemetry(app):
+  writer = TelemetryWriter(
+    app,
+    queue_size=app.config.get('TELEMETRY_QUEUE_SIZE', DEFAULT_QUEUE_SIZE),
+    batch_size=app.config.get('TELEMETRY_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+    flush_interval=app.config.get('TELEMETRY_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+    rollup_interval=app.config.get('TELEMETRY_ROLLUP_INTERVAL', DEFAULT_ROLLUP_INTERVAL),
+    rollup_settle=app.config.get('TELEMETRY_ROLLUP_SETTLE', DEFAULT_ROLLUP_SETTLE)
+  )
+  app.extensions['telemetry'] = writer
+  writers.add(writer)
+  return writer
+
+
+@atexit.register
+def stop_writers():
+  for writer in list(writers):
+    writer.stop()
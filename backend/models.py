@@ -1,8 +1,13 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+import datetime
+import logging
+from sqlalchemy import Column, String, Integer, Text, DateTime, Boolean, create_engine, event, inspect
+from sqlalchemy.orm import configure_mappers, object_session
 from flask_sqlalchemy import SQLAlchemy
 import json
 
+logger = logging.getLogger(__name__)
+
 database_name = "trivia"
 database_path = "postgresql://{}/{}".format('postgres:marco@localhost:5432', database_name)
 
@@ -11,13 +16,36 @@ db = SQLAlchemy()
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    no connection is opened here; the engine connects on the first query
+    pass create_tables=True to also run create_all (see init_db)
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, create_tables=False):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
-    db.create_all()
+    if create_tables:
+        init_db(app)
+
+'''
+init_db(app)
+    creates any missing tables; run once per deployment with `flask init-db`
+'''
+def init_db(app):
+    with app.app_context():
+        db.create_all()
+
+'''
+warmup_db(app)
+    builds the engine and mappers and checks connectivity, then empties the pool
+    so no open connection is inherited by forked workers (safe with gunicorn --preload)
+'''
+def warmup_db(app):
+    with app.app_context():
+        configure_mappers()
+        engine = db.engine
+        engine.execute('SELECT 1')
+        engine.dispose()
 
 '''
 Question
@@ -75,4 +103,139 @@ class Category(db.Model):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+'''
+PageSnapshot
+    precomputed response payloads for hot read paths, keyed by page
+    dirty_since is the first unreflected question change (bounds staleness);
+    version is bumped by every change so a rebuild can tell whether it missed one
+'''
+class PageSnapshot(db.Model):
+  __tablename__ = 'page_snapshots'
+
+  key = Column(String, primary_key=True)
+  payload = Column(Text)
+  refreshed_at = Column(DateTime)
+  dirty_since = Column(DateTime)
+  version = Column(Integer, nullable=False, default=0)
+
+  def __init__(self, key, payload):
+    self.key = key
+    self.payload = payload
+    self.refreshed_at = datetime.datetime.utcnow()
+    self.version = 0
+
+  def is_stale(self, max_staleness):
+    if self.dirty_since is None:
+      return False
+    return (datetime.datetime.utcnow() - self.dirty_since).total_seconds() >= max_staleness
+
+'''
+AnswerEvent
+    append-only log of quiz telemetry: kind is 'served' or 'answered'
+    written in batches by the telemetry writer, never updated
+'''
+class AnswerEvent(db.Model):
+  __tablename__ = 'answer_events'
+
+  id = Column(Integer, primary_key=True)
+  question_id = Column(Integer, index=True)
+  kind = Column(String)
+  correct = Column(Boolean)
+  created_at = Column(DateTime, index=True)
+
+'''
+QuestionStats
+    per-question aggregates rolled up from answer_events
+'''
+class QuestionStats(db.Model):
+  __tablename__ = 'question_stats'
+
+  question_id = Column(Integer, primary_key=True)
+  category = Column(Integer, index=True)
+  served = Column(Integer, default=0)
+  answered = Column(Integer, default=0)
+  correct = Column(Integer, default=0)
+
+  def __init__(self, question_id, category):
+    self.question_id = question_id
+    self.category = category
+    self.served = 0
+    self.answered = 0
+    self.correct = 0
+
+  def format(self):
+    return {
+      'question_id': self.question_id,
+      'category': self.category,
+      'served': self.served,
+      'answered': self.answered,
+      'correct': self.correct,
+      'correct_rate': self.correct / self.answered if self.answered else None
+    }
+
+'''
+RollupWatermark
+    id of the last answer event already included in a rollup
+'''
+class RollupWatermark(db.Model):
+  __tablename__ = 'rollup_watermarks'
+
+  name = Column(String, primary_key=True)
+  last_event_id = Column(Integer)
+
+  def __init__(self, name):
+    self.name = name
+    self.last_event_id = 0
+
+'''
+on_questions_changed(listener)
+    registers listener(changes) to run after a commit that inserted, updated or deleted questions
+    changes is a list of ('insert' | 'delete', question.format()); an update is a delete of the
+    old values followed by an insert of the new ones
+'''
+question_listeners = []
+
+def on_questions_changed(listener):
+  question_listeners.append(listener)
+  return listener
+
+def _record_change(question, action, data=None):
+  session = object_session(question)
+  if session is not None:
+    session.info.setdefault('question_changes', []).append((action, data or question.format()))
+
+@event.listens_for(Question, 'after_insert')
+def _question_inserted(mapper, connection, question):
+  _record_change(question, 'insert')
+
+@event.listens_for(Question, 'after_update')
+def _question_updated(mapper, connection, question):
+  old = question.format()
+  state = inspect(question)
+  for name in ('question', 'answer', 'category', 'difficulty'):
+    history = state.attrs[name].history
+    if history.deleted:
+      old[name] = history.deleted[0]
+  _record_change(question, 'delete', old)
+  _record_change(question, 'insert')
+
+@event.listens_for(Question, 'after_delete')
+def _question_deleted(mapper, connection, question):
+  _record_change(question, 'delete')
+
+@event.listens_for(db.session, 'after_commit')
+def _questions_committed(session):
+  changes = session.info.pop('question_changes', None)
+  if changes:
+    for listener in question_listeners:
+      # The write is already committed; a failing listener must not fail it
+      try:
+        listener(changes)
+      except Exception:
+        logger.exception('Question change listener %s failed', listener.__name__)
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _questions_rolled_back(session, previous_transaction):
+  session.info.pop('question_changes', None)
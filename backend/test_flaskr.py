@@ -1,32 +1,34 @@
 import os
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import time
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.admission import TokenBucket
+from flaskr.partitions import all_questions, category_questions
+from flaskr.buckets import DifficultyBuckets
+from flaskr.snapshots import invalidate_snapshots, HOMEPAGE_KEY
+from models import db, init_db, Question, Category, PageSnapshot
 
 from flask_cors import CORS
+from sqlalchemy import create_engine
+
+database_name = "trivia_test"
+database_path = "postgresql://{}/{}".format('postgres:marco@localhost:5432', database_name)
 
 
 class CategoriesTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        """Create the tables once for the whole test case."""
+        init_db(create_app({'SQLALCHEMY_DATABASE_URI': database_path}))
+
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': database_path})
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgresql://{}/{}".format('postgres:marco@localhost:5432', self.database_name)
-
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
     
     def tearDown(self):
         """Executed after reach test"""
@@ -57,21 +59,15 @@ class CategoriesTestCase(unittest.TestCase):
 class QuestionsTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        """Create the tables once for the whole test case."""
+        init_db(create_app({'SQLALCHEMY_DATABASE_URI': database_path}))
+
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': database_path})
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgresql://{}/{}".format('postgres:marco@localhost:5432', self.database_name)
-
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
 
     def tearDown(self):
         """Executed after reach test"""
@@ -167,6 +163,507 @@ class QuestionsTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 405)
         self.assertEqual(res.get_json()['success'], False)
 
+class AdmissionTestCase(unittest.TestCase):
+    """This class represents the admission control test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': database_path,
+            'ADMISSION_LIMITS': {
+                'get_admission_stats': {'rate': 0.01, 'burst': 1},
+                'get_categories': {'concurrency': 1, 'queue_timeout': 0}
+            }
+        })
+        self.client = self.app.test_client
+
+    # TEST token bucket refuses once burst is spent
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1, burst=2)
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(bucket.take(), 0)
+        self.assertTrue(bucket.take() > 0)
+
+    # TEST to generate 429 once the rate limit is exceeded
+    def test_rate_limited_429(self):
+        res = self.client().get('/admission')
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/admission')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Too Many Requests')
+        self.assertTrue(int(res.headers['Retry-After']) > 0)
+
+    # TEST CORS preflights are not counted or shed
+    def test_preflight_not_limited(self):
+        for _ in range(3):
+            res = self.client().open('/admission', method='OPTIONS')
+            self.assertEqual(res.status_code, 200)
+
+        stats = self.app.extensions['admission']['get_admission_stats'].stats()
+        self.assertEqual(stats['admitted'], 0)
+        self.assertEqual(stats['shed_rate_limited'], 0)
+        self.assertEqual(stats['shed_overloaded'], 0)
+
+    # TEST to generate 503 when no concurrency slot is free
+    def test_overloaded_503(self):
+        limiter = self.app.extensions['admission']['get_categories']
+        limiter.acquire()
+
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        limiter.release()
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertTrue(res.headers['Retry-After'])
+        self.assertEqual(limiter.stats()['shed_overloaded'], 1)
+
+class StartupTestCase(unittest.TestCase):
+    """This class represents the app startup test case"""
+
+    # TEST app construction does not touch the database
+    def test_create_app_without_database(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql://nobody@127.0.0.1:1/unreachable'})
+
+        self.assertTrue(app.config['STARTUP_SECONDS'] >= 0)
+        self.assertEqual(app.test_client().get('/admission').status_code, 200)
+
+    # TEST startup time is reported
+    def test_get_status(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': database_path})
+        res = app.test_client().get('/status')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['startup_seconds'], app.config['STARTUP_SECONDS'])
+
+class SnapshotTestCase(unittest.TestCase):
+    """This class represents the page snapshot test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Create the tables once for the whole test case."""
+        init_db(create_app({'SQLALCHEMY_DATABASE_URI': database_path}))
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': database_path,
+            'SNAPSHOT_MAX_STALENESS': 0
+        })
+        self.client = self.app.test_client
+
+    # TEST snapshots are stored and refreshed after insert and delete
+    def test_snapshots_refreshed_on_write(self):
+        total = self.client().get('/questions').get_json()['total_questions']
+        category_total = self.client().get('/categories/2/questions').get_json()['total_questions']
+
+        with self.app.app_context():
+            self.assertTrue(PageSnapshot.query.get('questions:1') is not None)
+            self.assertTrue(PageSnapshot.query.get('category:2') is not None)
+
+        res = self.client().post('/questions', json={
+            "question": "snapshot test",
+            "answer": "test",
+            "difficulty": 1,
+            "category": 1
+        })
+        created = res.get_json()['created']
+
+        self.assertEqual(self.client().get('/questions').get_json()['total_questions'], total + 1)
+        self.assertEqual(self.client().get('/categories/2/questions').get_json()['total_questions'], category_total + 1)
+
+        self.client().delete('/questions/{}'.format(created))
+
+        self.assertEqual(self.client().get('/questions').get_json()['total_questions'], total)
+        self.assertEqual(self.client().get('/categories/2/questions').get_json()['total_questions'], category_total)
+
+    # TEST a write committed while a snapshot is being rebuilt keeps it dirty
+    def test_write_during_rebuild(self):
+        store = self.app.extensions['snapshots']
+        total = self.client().get('/questions').get_json()['total_questions']
+        created = []
+        build_homepage = store.builders['questions']
+
+        def build_then_write(page):
+            payload = build_homepage(page)
+            if not created:
+                # Another worker commits a question after the query, before the UPDATE
+                question = Question(question="rebuild race", answer="test", difficulty=1, category=1)
+                question.insert()
+                created.append(question.id)
+            return payload
+
+        store.builders['questions'] = build_then_write
+        try:
+            with self.app.app_context():
+                PageSnapshot.query.filter(PageSnapshot.key == HOMEPAGE_KEY).delete()
+                db.session.commit()
+                self.assertEqual(store.get(HOMEPAGE_KEY)['total_questions'], total)
+                self.assertEqual(store.get(HOMEPAGE_KEY)['total_questions'], total + 1)
+        finally:
+            store.builders['questions'] = build_homepage
+            self.client().delete('/questions/{}'.format(created[0]))
+
+    # TEST writes and reads still succeed when snapshots cannot be stored
+    def test_write_without_snapshot_table(self):
+        with self.app.app_context():
+            PageSnapshot.__table__.drop(db.engine)
+
+        try:
+            res = self.client().post('/questions', json={
+                "question": "snapshot test",
+                "answer": "test",
+                "difficulty": 1,
+                "category": 1
+            })
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(self.client().get('/questions').status_code, 200)
+
+            res = self.client().delete('/questions/{}'.format(res.get_json()['created']))
+            self.assertEqual(res.status_code, 200)
+        finally:
+            init_db(self.app)
+
+    # TEST questions without a category only refresh the landing page
+    def test_invalidate_without_category(self):
+        store = self.app.extensions['snapshots']
+        with self.app.app_context():
+            invalidate_snapshots([('insert', {'id': 0, 'category': None})])
+        self.assertFalse(any(key.endswith('None') for key in store.pending))
+
+class TelemetryTestCase(unittest.TestCase):
+    """This class represents the quiz telemetry test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Create the tables once for the whole test case."""
+        init_db(create_app({'SQLALCHEMY_DATABASE_URI': database_path}))
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': database_path,
+            'TELEMETRY_BATCH_SIZE': 1,
+            'TELEMETRY_FLUSH_INTERVAL': 0.05,
+            'TELEMETRY_ROLLUP_INTERVAL': 0,
+            'TELEMETRY_ROLLUP_SETTLE': 0
+        })
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        """Stop the background writer so threads do not pile up across tests."""
+        self.app.extensions['telemetry'].stop()
+
+    def wait_for_stats(self, url, key, expected):
+        """Poll until the background writer has rolled up the events."""
+        for _ in range(100):
+            res = self.client().get(url)
+            if res.status_code == 200 and res.get_json()['stats'][key] >= expected:
+                return res.get_json()['stats']
+            time.sleep(0.05)
+        self.fail('answer events were not rolled up')
+
+    # TEST answer events are batched and rolled up into question stats
+    def test_record_answer(self):
+        question_id = self.client().get('/questions').get_json()['questions'][0]['id']
+        url = '/questions/{}/stats'.format(question_id)
+        res = self.client().get(url)
+        before = res.get_json()['stats']['answered'] if res.status_code == 200 else 0
+
+        res = self.client().post('/quizzes/answers', json={"question_id": question_id, "correct": True})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['recorded'], True)
+
+        stats = self.wait_for_stats(url, 'answered', before + 1)
+        self.assertTrue(stats['correct'] > 0)
+
+        res = self.client().get('/categories/{}/stats'.format(stats['category']))
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.get_json()['answered'] > 0)
+
+    # TEST events for unknown questions are discarded by the rollup
+    def test_record_answer_unknown_question(self):
+        question_id = self.client().get('/questions').get_json()['questions'][0]['id']
+        url = '/questions/{}/stats'.format(question_id)
+        res = self.client().get(url)
+        before = res.get_json()['stats']['answered'] if res.status_code == 200 else 0
+
+        self.client().post('/quizzes/answers', json={"question_id": 9999999, "correct": True})
+        self.client().post('/quizzes/answers', json={"question_id": question_id, "correct": False})
+        self.wait_for_stats(url, 'answered', before + 1)
+
+        res = self.client().get('/questions/9999999/stats')
+        self.assertEqual(res.status_code, 404)
+
+        res = self.client().get('/status')
+        self.assertEqual(res.get_json()['telemetry']['dropped'], 0)
+
+    # TEST stopping the writer ends its thread and writes what is still queued
+    def test_stop_writer(self):
+        writer = self.app.extensions['telemetry']
+        question_id = self.client().get('/questions').get_json()['questions'][0]['id']
+        self.client().post('/quizzes/answers', json={"question_id": question_id, "correct": True})
+        worker = writer.worker
+
+        writer.stop()
+        writer.record('answered', question_id, True)
+        writer.stop()
+
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(writer.stats()['queued'], 0)
+        self.assertEqual(writer.stats()['written'], 2)
+
+    # TEST to generate 400 when the answer event is malformed
+    def test_record_answer_400(self):
+        res = self.client().post('/quizzes/answers', json={"question_id": 1})
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json()['success'], False)
+
+        res = self.client().post('/quizzes/answers', json={"question_id": True, "correct": True})
+        self.assertEqual(res.status_code, 400)
+
+    # TEST to generate 404 for a question without stats
+    def test_question_stats_404(self):
+        res = self.client().get('/questions/9999999/stats')
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(res.get_json()['success'], False)
+
+class PartitionTestCase(unittest.TestCase):
+    """This class represents the partitioned questions test case"""
+
+    schema = "partition_test"
+    schema_path = database_path + "?options=-csearch_path%3D" + schema
+
+    @classmethod
+    def setUpClass(cls):
+        """Copy the trivia tables into a throwaway schema and partition them there."""
+        cls.engine = create_engine(database_path)
+        with cls.engine.begin() as connection:
+            connection.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}".format(cls.schema))
+            connection.execute("CREATE TABLE {0}.categories (id serial PRIMARY KEY, type text)".format(cls.schema))
+            connection.execute("INSERT INTO {0}.categories (id, type) SELECT id, type FROM public.categories".format(cls.schema))
+            connection.execute(
+                "CREATE TABLE {0}.questions (id serial PRIMARY KEY, question text, answer text, difficulty integer, "
+                "category integer CONSTRAINT category REFERENCES {0}.categories (id) ON UPDATE CASCADE ON DELETE SET NULL)".format(cls.schema))
+            connection.execute(
+                "INSERT INTO {0}.questions (id, question, answer, difficulty, category) "
+                "SELECT id, question, answer, difficulty, category FROM public.questions".format(cls.schema))
+            connection.execute("INSERT INTO {0}.questions (question, answer, difficulty) VALUES ('no category', 'test', 1)".format(cls.schema))
+            connection.execute("SELECT setval('{0}.questions_id_seq', (SELECT max(id) FROM {0}.questions))".format(cls.schema))
+
+        app = create_app({'SQLALCHEMY_DATABASE_URI': cls.schema_path})
+        init_db(app)
+        result = app.test_cli_runner().invoke(args=['partition-questions'])
+        assert result.exit_code == 0, result.output
+
+    @classmethod
+    def tearDownClass(cls):
+        """Drop the throwaway schema."""
+        with cls.engine.begin() as connection:
+            connection.execute("DROP SCHEMA {0} CASCADE".format(cls.schema))
+        cls.engine.dispose()
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.schema_path,
+            'QUESTION_PARTITIONING': True
+        })
+        self.client = self.app.test_client
+        self.plain_app = create_app({'SQLALCHEMY_DATABASE_URI': self.schema_path})
+
+    def tearDown(self):
+        """Release the connections held by the apps."""
+        for app in (self.app, self.plain_app):
+            with app.app_context():
+                db.engine.dispose()
+
+    # TEST routed reads match reads through the parent table
+    def test_partitioned_reads(self):
+        with self.plain_app.app_context():
+            expected_all = all_questions()
+            expected_category = category_questions(2)
+
+        with self.app.app_context():
+            self.assertEqual(all_questions(), expected_all)
+            self.assertEqual(category_questions(2), expected_category)
+            self.assertTrue(len(self.app.extensions['partitions'].partitions()) > 1)
+            self.assertTrue(any(question['category'] is None for question in expected_all))
+
+    # TEST "ALL" reads use the parent table when the connection budget is spent
+    def test_partitioned_reads_without_connections(self):
+        with self.plain_app.app_context():
+            expected_all = all_questions()
+
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.schema_path,
+            'QUESTION_PARTITIONING': True,
+            'QUESTION_PARTITION_WORKERS': 2,
+            'QUESTION_PARTITION_CONNECTIONS': 3
+        })
+        router = app.extensions['partitions']
+        with app.app_context():
+            self.assertEqual(all_questions(), expected_all)
+            self.assertTrue(router.reserve(2))
+            try:
+                self.assertFalse(router.reserve(2))
+                self.assertEqual(all_questions(), expected_all)
+            finally:
+                router.connections.release()
+                router.connections.release()
+            self.assertTrue(router.reserve(3))
+            db.engine.dispose()
+
+    # TEST the category foreign key survives and questions without a category can still be created
+    def test_partitioned_schema(self):
+        with self.engine.connect() as connection:
+            foreign_key = connection.execute(
+                "SELECT pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = '{0}.questions'::regclass AND contype = 'f'".format(self.schema)).scalar()
+        self.assertTrue('ON DELETE SET NULL' in foreign_key)
+
+        res = self.client().post('/questions', json={"question": "test", "answer": "test", "difficulty": 1})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().delete('/questions/{}'.format(res.get_json()['created']))
+        self.assertEqual(res.status_code, 200)
+
+    # TEST routing falls back to the plain table when it is not partitioned
+    def test_routing_without_partitions(self):
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': database_path,
+            'QUESTION_PARTITIONING': True
+        })
+        res = app.test_client().get('/questions?page=2')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(res.get_json()['questions']))
+        self.assertFalse(app.extensions['partitions'].enabled)
+
+class AdaptiveQuizTestCase(unittest.TestCase):
+    """This class represents the adaptive quiz test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': database_path})
+        self.client = self.app.test_client
+        self.buckets = DifficultyBuckets()
+        self.buckets.load([
+            {'id': 1, 'question': 'a', 'answer': 'a', 'category': 1, 'difficulty': 1},
+            {'id': 2, 'question': 'b', 'answer': 'b', 'category': 1, 'difficulty': 5},
+            {'id': 3, 'question': 'c', 'answer': 'c', 'category': 2, 'difficulty': 5}
+        ])
+
+    # TEST draws respect category, difficulty and previous questions
+    def test_bucket_draw(self):
+        self.assertEqual(self.buckets.draw(1, 5)['id'], 2)
+        self.assertEqual(self.buckets.draw(None, 5, exclude={2})['id'], 3)
+        self.assertEqual(self.buckets.draw(1, 5, exclude={2}), None)
+
+    # TEST draws skipping most of a bucket stay consistent with deletes
+    def test_bucket_draw_excluded(self):
+        buckets = DifficultyBuckets()
+        buckets.load([{'id': i, 'question': 'q', 'answer': 'a', 'category': 1, 'difficulty': 2} for i in range(1, 101)])
+        exclude = set(range(1, 100))
+
+        for _ in range(10):
+            self.assertEqual(buckets.draw(1, 2, exclude)['id'], 100)
+
+        buckets.remove(100)
+        self.assertEqual(buckets.draw(1, 2, exclude), None)
+        for key, bucket in buckets.buckets.items():
+            self.assertEqual({question['id']: index for index, question in enumerate(bucket)}, buckets.positions[key])
+
+    # TEST buckets are updated incrementally
+    def test_bucket_insert_delete(self):
+        self.buckets.remove(2)
+        self.assertEqual(self.buckets.draw(1, 5), None)
+        self.assertEqual(self.buckets.draw(None, 5)['id'], 3)
+
+        self.buckets.add({'id': 4, 'question': 'd', 'answer': 'd', 'category': '1', 'difficulty': '5'})
+        self.assertEqual(self.buckets.draw(1, 5)['id'], 4)
+
+    # TEST streaks move towards harder or easier questions
+    def test_bucket_draw_adaptive(self):
+        self.assertEqual(self.buckets.draw_adaptive(1, 3)['id'], 2)
+        self.assertEqual(self.buckets.draw_adaptive(1, -3)['id'], 1)
+        self.assertEqual(self.buckets.draw_adaptive(1, 3, exclude={2})['id'], 1)
+
+    # TEST changes made during a rebuild are kept when the rebuilt buckets are swapped in
+    def test_bucket_rebuild_replays_changes(self):
+        self.assertTrue(self.buckets.claim_rebuild())
+        self.assertFalse(self.buckets.claim_rebuild())
+
+        self.buckets.apply([('insert', {'id': 4, 'question': 'd', 'answer': 'd', 'category': 2, 'difficulty': 1})])
+        self.buckets.load([{'id': 1, 'question': 'a', 'answer': 'a', 'category': 1, 'difficulty': 1}])
+
+        self.assertEqual(self.buckets.draw(2, 1)['id'], 4)
+        self.assertEqual(self.buckets.draw(1, 5), None)
+        self.assertTrue(self.buckets.claim_rebuild())
+
+    # TEST expired buckets keep serving while they are rebuilt
+    def test_get_questions_play_adaptive_expired(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': database_path, 'QUIZ_BUCKETS_TTL': 0})
+        data = {
+            "quiz_category": {
+                "type": "click",
+                "id": 0
+            },
+            "previous_questions": [],
+            "mode": "adaptive",
+            "streak": 0
+        }
+        for _ in range(3):
+            res = app.test_client().post('/quizzes', json=data)
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(len(res.get_json()['question']))
+
+    # TEST to get an adaptive quiz question
+    def test_get_questions_play_adaptive(self):
+        data = {
+            "quiz_category": {
+                "type": "click",
+                "id": 0
+            },
+            "previous_questions": [],
+            "mode": "adaptive",
+            "streak": 2
+        }
+        res = self.client().post('/quizzes', json=data)
+        data_result = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data_result['success'], True)
+        self.assertTrue(len(data_result['question']))
+
+    # TEST to generate 400 when the streak is not a number
+    def test_get_questions_play_adaptive_400(self):
+        data = {
+            "quiz_category": {
+                "type": "click",
+                "id": 0
+            },
+            "previous_questions": [],
+            "mode": "adaptive",
+            "streak": "high"
+        }
+        res = self.client().post('/quizzes', json=data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json()['success'], False)
+
+        data['streak'] = True
+        res = self.client().post('/quizzes', json=data)
+        self.assertEqual(res.status_code, 400)
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file